@@ -134,6 +134,65 @@
         botMessageDiv.textContent = message;
         messagesContainer.appendChild(botMessageDiv);
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
+        return botMessageDiv;
+    }
+
+    // /chat answers with Server-Sent Events: "delta" events with parts of the answer
+    // while it's being generated, then one "message" event with the final message.
+    // The streamed text is shown right away and removed once the final message arrives.
+    async function readChatStream(response, indicator) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+        let streamedMessageDiv = null;
+        let data = null;
+
+        try {
+            while (true) {
+                const {value, done} = await reader.read();
+                if (done) {
+                    break;
+                }
+                buffer += decoder.decode(value, {stream: true});
+
+                let boundary;
+                while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+                    const rawEvent = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+
+                    let eventType = "message";
+                    let eventData = "";
+                    for (const line of rawEvent.split("\n")) {
+                        if (line.startsWith("event: ")) {
+                            eventType = line.slice(7);
+                        } else if (line.startsWith("data: ")) {
+                            eventData += line.slice(6);
+                        }
+                    }
+                    const payload = JSON.parse(eventData);
+
+                    if (eventType === "delta") {
+                        if (!streamedMessageDiv) {
+                            removeTypingIndicator(indicator);
+                            streamedMessageDiv = appendBotMessage("");
+                        }
+                        streamedMessageDiv.textContent += payload.text;
+                        messagesContainer.scrollTop = messagesContainer.scrollHeight;
+                    } else {
+                        data = payload;
+                    }
+                }
+            }
+        } catch (error) {
+            // Connection dropped or a broken event: there's no final message to show
+            console.error(error);
+            data = null;
+        }
+
+        if (streamedMessageDiv) {
+            streamedMessageDiv.remove();
+        }
+        return data;
     }
 
 
@@ -206,10 +265,16 @@
             body: JSON.stringify({message: userMessage, thread_id: sessionStorage.getItem("thread_id")})
         });
 
-        const data = await response.json();
+        // The stream can end without a final message (e.g. an error response or a dropped connection)
+        const data = response.ok ? await readChatStream(response, indicator) : null;
 
         removeTypingIndicator(indicator);
 
+        if (data === null) {
+            appendBotMessage("Er is iets misgegaan. Probeer het later opnieuw.");
+            return;
+        }
+
         if (data.message === "True") {
             appendBotMessage("Ons gesprek is afgerond. Heb je later nog vragen? Dan kan je ons altijd opnieuw contacteren. This conversation ended. If you want to start a new conversation, send a new message.")
             clearTimeout(timeoutId);
@@ -1,9 +1,10 @@
 import requests
-from util import get_month_name, extract_json, validate_email, validate_phone
+from util import get_month_name, extract_json, contains_json, validate_email, validate_phone
 import os
 from dotenv import load_dotenv
 import json
-from init_azure import make_message, run_agent, get_agents, get_message_list
+import asyncio
+from init_azure import make_message, run_agent, get_agents
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
 from zoneinfo import ZoneInfo
@@ -25,26 +26,27 @@ response = requests.get("https://api.cal.com/v2/event-types", headers=headers_ev
 
 
 
-agent_data, agent_summary, agent_summary_thread = get_agents()
-
-
 async def try_to_make_an_appointment(chatbot_message):
+    agent_data, agent_summary = get_agents()
+
     try: 
         # The input is always in dict type, so here we extract the message.
         # The other dict keys are role and thread_id.
         message = chatbot_message["message"]
         thread_id = chatbot_message["thread_id"]
 
+        # A regular response from a chatbot, nothing to reserve
+        if isinstance(message, str) and not contains_json(message):
+            return {"role": "assistant", "message": message, "thread_id": thread_id}
+
         # Trying to extract a message in a dict format.
         # There are two possibilities: either it's a regular response from a chatbot which causes a JSONDecodeError here
         # Or it's a dict which will be used to fill in data for the appointment further down in this method.
         message_json = extract_json(message)
 
         start, language = message_json["start"], "nl"
-        available_slots = get_days_and_times(event_type_id, start, language=language)
 
         name, email, phone_number= message_json["name"], message_json["email"], message_json["phone_number"]
-        msg = f"Je afspraak voor {available_slots[2]} is succesvol ingepland. We nemen zo spoedig mogelijk contact met je op."
 
         email = validate_email(email)
         phone_number = validate_phone(phone_number)
@@ -54,7 +56,11 @@ async def try_to_make_an_appointment(chatbot_message):
         elif phone_number == False:
             msg = 'Helaas heeft het telefoonnummer niet de juiste opmaak. Zorg ervoor dat het de structur +1234567890 heeft.'
         else:
-            status_code = book_cal_event(name, email, phone_number, start, language)
+            available_slots = await get_days_and_times(event_type_id, start, language=language)
+            msg = f"Je afspraak voor {available_slots[2]} is succesvol ingepland. We nemen zo spoedig mogelijk contact met je op."
+
+            # requests is blocking, so it runs in a thread to keep the event loop free
+            status_code = await asyncio.to_thread(book_cal_event, name, email, phone_number, start, language)
 
             if status_code == 400:
                 if language == "en":
@@ -63,11 +69,9 @@ async def try_to_make_an_appointment(chatbot_message):
                     msg = f"Helaas is {available_slots[2]} niet beschikbaar. De dichtstbijzijnde tijdslots zijn {available_slots[0]} en {available_slots[1]}." 
 
             
-            make_message(thread_id, "assistant", msg)
+            await make_message(thread_id, "assistant", msg)
             run = await run_agent(thread_id, agent_data.id)
 
-            print(get_message_list(thread_id))
-
         return {"role": "assistant", "message": msg, "thread_id": thread_id}
     except (ValueError, json.decoder.JSONDecodeError) as e:
         return {"role": "assistant", "message": message, "thread_id": thread_id}
@@ -113,7 +117,7 @@ def get_dates_in_timeframe(event_type_id, start, end, time_zone):
     return response
 
 
-def get_available_slots(event_type_id, target, start=None, end=None, tz="Europe/Brussels", language="nl"):
+async def get_available_slots(event_type_id, target, start=None, end=None, tz="Europe/Brussels", language="nl"):
     dt = parse_date(target, tz)
     target = str(dt).replace(" ", "T")
 
@@ -124,9 +128,6 @@ def get_available_slots(event_type_id, target, start=None, end=None, tz="Europe/
         start = one_month_before_str
 
 
-    response_before_date = get_dates_in_timeframe(event_type_id, start, target, tz)
-
-
     if end == None:
         one_month_after = dt + relativedelta(months=2)
         one_month_after_str = str(one_month_after).replace(" ", "T")
@@ -134,7 +135,11 @@ def get_available_slots(event_type_id, target, start=None, end=None, tz="Europe/
         end = one_month_after_str
 
 
-    response_after_date = get_dates_in_timeframe(event_type_id, target, end, tz)
+    # The two timeframes don't depend on each other, so they're requested at the same time
+    response_before_date, response_after_date = await asyncio.gather(
+        asyncio.to_thread(get_dates_in_timeframe, event_type_id, start, target, tz),
+        asyncio.to_thread(get_dates_in_timeframe, event_type_id, target, end, tz)
+    )
 
     return (response_before_date, response_after_date, language)
 
@@ -149,8 +154,8 @@ def _extract_day_and_time_out_of_data(input_date, language):
     return day_number, month_name, formatted_time
 
 
-def get_days_and_times(event_type_id, target, start=None, end=None, tz="Europe/Brussels", language="nl"):
-    response_before_date, response_after_date, language = get_available_slots(event_type_id, target, start, end, tz, language)
+async def get_days_and_times(event_type_id, target, start=None, end=None, tz="Europe/Brussels", language="nl"):
+    response_before_date, response_after_date, language = await get_available_slots(event_type_id, target, start, end, tz, language)
 
     # Get the closest day available to the target (after the target time)
     earliest_day_after_target = list(response_after_date.json()["data"])[0]
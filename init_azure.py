@@ -1,75 +1,245 @@
-from azure.ai.projects import AIProjectClient
-from azure.identity import DefaultAzureCredential
-from azure.ai.agents.models import ListSortOrder
+from azure.ai.projects.aio import AIProjectClient
+from azure.identity.aio import DefaultAzureCredential
+from azure.ai.agents.models import ListSortOrder, ThreadRun, MessageDeltaChunk
+from azure.core.pipeline.transport import AioHttpTransport
 import os
 from dotenv import load_dotenv
 import asyncio
+import time
+from types import SimpleNamespace
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
 
+# Set up in init_project() (called from the FastAPI lifespan) so that the
+# async client and its HTTP transport live on the app's event loop.
+project = None
 
-credential=DefaultAzureCredential()
-project = AIProjectClient(
-    credential=credential,
-    endpoint=os.getenv("AI_D_PROJECT_ENDPOINT")
-)
+agent_data = None
+agent_summary = None
 
+# Threads of the summary agent. Every summary takes its own thread from the pool,
+# so that summaries can run in parallel and no thread grows forever.
+SUMMARY_THREADS = None
+summary_thread_pool_size = 8
+# Messages a summary thread can hold before it's replaced with a fresh one
+summary_thread_max_messages = 20
 
-agent_data = project.agents.get_agent(os.getenv("AGENT_DATA_ID"))
-agent_summary = project.agents.get_agent(os.getenv("AGENT_SUMMARY_ID"))
-agent_summary_thread = project.agents.threads.create()
 
-def get_agents():
-    return agent_data, agent_summary, agent_summary_thread
+class CachingCredential:
+    """Async credential wrapper that keeps access tokens in memory and
+    only asks the wrapped credential for a new one when the cached token
+    is about to expire (less than 5 minutes left)."""
+
+    refresh_margin = 300
+
+    def __init__(self, credential):
+        self._credential = credential
+        self._tokens = {}
+        self._lock = asyncio.Lock()
+
+    async def get_token(self, *scopes, **kwargs):
+        key = (scopes, kwargs.get("tenant_id"), kwargs.get("claims"))
+
+        token = self._tokens.get(key)
+        if token and token.expires_on - time.time() > self.refresh_margin:
+            return token
+
+        # Only one request refreshes the token, the others wait and reuse it.
+        async with self._lock:
+            token = self._tokens.get(key)
+            if token and token.expires_on - time.time() > self.refresh_margin:
+                return token
+
+            token = await self._credential.get_token(*scopes, **kwargs)
+            self._tokens[key] = token
+            return token
+
+    async def close(self):
+        await self._credential.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+def create_credential():
+    """Create the (token caching) Azure credential.
+
+    Called from the lifespan rather than at import, once per worker. Credentials that
+    can't be used on a server are excluded so that they aren't probed."""
+    return CachingCredential(DefaultAzureCredential(
+        exclude_visual_studio_code_credential=True,
+        exclude_shared_token_cache_credential=True
+    ))
+
+
+async def init_project(session, credential):
+    """Create the Azure project client and fetch the agents.
+
+    Args:
+        session: aiohttp.ClientSession owned by the app. The client reuses its
+        connection pool instead of opening its own.
+        credential: credential made by create_credential, owned (and closed) by the app.
+    """
+    global project, agent_data, agent_summary, SUMMARY_THREADS
+
+    project = AIProjectClient(
+        credential=credential,
+        endpoint=os.getenv("AI_D_PROJECT_ENDPOINT"),
+        transport=AioHttpTransport(session=session, session_owner=False)
+    )
+
+    agent_data = await project.agents.get_agent(os.getenv("AGENT_DATA_ID"))
+    agent_summary = await project.agents.get_agent(os.getenv("AGENT_SUMMARY_ID"))
 
+    SUMMARY_THREADS = asyncio.Queue(maxsize=summary_thread_pool_size)
+    threads = await asyncio.gather(*(project.agents.threads.create() for _ in range(summary_thread_pool_size)))
+    for thread in threads:
+        SUMMARY_THREADS.put_nowait((thread, 0))
 
-def make_message(thread_id, role, input_message):
-    message = project.agents.messages.create(
+
+async def close_project():
+    # Deleting the summary threads so that every restart doesn't leave a pool of threads behind.
+    # Errors are ignored, a thread that can't be deleted shouldn't stop the shutdown.
+    threads = []
+    while not SUMMARY_THREADS.empty():
+        thread, message_count = SUMMARY_THREADS.get_nowait()
+        threads.append(thread)
+    await asyncio.gather(*(project.agents.threads.delete(thread.id) for thread in threads), return_exceptions=True)
+
+    await project.close()
+
+
+def get_agents():
+    return agent_data, agent_summary
+
+
+@asynccontextmanager
+async def summary_thread():
+    """Borrow a thread from the summary thread pool (waits if all of them are in use).
+
+    The messages of a thread are counted approximately, as 2 per summary (the conversation
+    and the summary); a failed or unusual run can add a different number.
+    Once a thread reaches about summary_thread_max_messages messages, it's replaced with a new one."""
+    thread, message_count = await SUMMARY_THREADS.get()
+    try:
+        yield thread
+    finally:
+        message_count += 2
+        if message_count >= summary_thread_max_messages:
+            try:
+                await project.agents.threads.delete(thread.id)
+                thread, message_count = await project.agents.threads.create(), 0
+            except Exception as e:
+                # Keep using the old thread rather than shrinking the pool
+                print(f"Failed to recycle summary thread {thread.id}: {e}")
+
+        SUMMARY_THREADS.put_nowait((thread, message_count))
+
+
+async def make_message(thread_id, role, input_message):
+    message = await project.agents.messages.create(
     thread_id=thread_id,
     role=role,
     content=input_message)
 
 
-def get_message_list(thread_id):
-    messages = list(project.agents.messages.list(
+def get_latest_messages(thread_id, page_size=2):
+    """Iterate over the messages of the thread, newest first.
+
+    Pages of page_size messages are only fetched while the iteration goes on,
+    so stopping at the last answer avoids downloading the rest of the history."""
+    return project.agents.messages.list(
         thread_id=thread_id,
-        order=ListSortOrder.ASCENDING
-        ))
-    
-    return messages
+        order=ListSortOrder.DESCENDING,
+        limit=page_size
+        )
+
+async def create_thread():
+    return await project.agents.threads.create()
+
+
+async def _wait_for_run(thread_id, run):
+    """Wait until the run is no longer queued/in progress, backing off
+    exponentially (0.1s -> 2s) so that short runs are detected quickly
+    without spamming Azure on long ones."""
+    delay = 0.1
+    while run.status in ("in_progress", "queued"):
+        await asyncio.sleep(delay)
+        run = await project.agents.runs.get(
+            thread_id=thread_id,
+            run_id=run.id
+        )
+        delay = min(delay * 2, 2.0)
+
+    return run
 
-def create_thread():
-    return project.agents.threads.create()
-    
 
-async def run_agent(thread_id, agent_id):
-    runs = list(project.agents.runs.list(thread_id=thread_id))
-    # print(len(runs) != 0)
-    # print(list(runs))
-    if len(list(runs)) != 0:
-        # print(len(list(runs)) != 0)
-        # print(len(list(runs)))
-        latest_run = list(runs)[0]
-        # print("working")
-        # for run in runs:
-        #     print(run.created_at)
-
-        while True:
-            latest_run = project.agents.runs.get(
-                thread_id=thread_id,
-                run_id=latest_run.id
-            )
-            if latest_run.status in ("in_progress", "queued"):
-                await asyncio.sleep(0.5)
-            else:
-                break
-
-    run = project.agents.runs.create_and_process(
+# Statuses of a run that is over (any other status means it's still going or waiting for something)
+finished_run_statuses = ("completed", "failed", "cancelled", "expired", "incomplete")
+
+
+async def _get_latest_run(thread_id):
+    # Only the latest run matters, so there's no need to fetch the whole run history.
+    async for run in project.agents.runs.list(thread_id=thread_id, limit=1):
+        return run
+    return None
+
+
+async def stream_agent(thread_id, agent_id):
+    """Run the agent and yield its events as they arrive:
+    ("delta", text) for every chunk of the answer and, at the end,
+    ("run", run) with the finished run. Only a "completed" run has a new answer,
+    any other status has to be treated as a failure."""
+    latest_run = await _get_latest_run(thread_id)
+    if latest_run:
+        await _wait_for_run(thread_id, latest_run)
+
+    # Streaming the run: Azure pushes the run events over one connection
+    # instead of us polling for the status until it's done.
+    run = None
+    error = None
+    async with await project.agents.runs.stream(
         thread_id=thread_id,
         agent_id=agent_id
-    )
-
-    return run
+    ) as stream:
+        async for event_type, event_data, _ in stream:
+            if isinstance(event_data, MessageDeltaChunk):
+                yield "delta", event_data.text
+            # The last run event has the final status
+            elif isinstance(event_data, ThreadRun):
+                run = event_data
+            # The SDK gives the data of an error event as a plain string
+            elif event_type == "error":
+                error = event_data
+
+    # The stream ended before the run was over (e.g. after an error event),
+    # so the run is looked up and waited for instead
+    if run is None or run.status not in finished_run_statuses:
+        run = await _get_latest_run(thread_id)
+        if run:
+            run = await _wait_for_run(thread_id, run)
+
+        # No tools are handled here, so a run waiting for tool outputs is cancelled
+        # to not block the next run on the thread
+        if run and run.status == "requires_action":
+            await project.agents.runs.cancel(thread_id=thread_id, run_id=run.id)
+            run = SimpleNamespace(status="failed", last_error="The run required an action")
+
+    if run is None:
+        run = SimpleNamespace(status="failed", last_error=error or "The run didn't start")
+    # An error event means there's no (complete) new answer, even if the run finished after it
+    elif error:
+        run = SimpleNamespace(status="failed", last_error=run.last_error or error)
+
+    yield "run", run
 
 
+async def run_agent(thread_id, agent_id):
+    async for event, data in stream_agent(thread_id, agent_id):
+        if event == "run":
+            return data
@@ -1,35 +1,85 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse
 from dotenv import load_dotenv
 import os
-import time
+import json
 import asyncio
+import aiohttp
+import httpx
 from contextlib import asynccontextmanager
-from supabase import create_client, Client
-from util import get_today_date, extract_json, remove_source
-from init_azure import get_agents, make_message, get_message_list, create_thread, run_agent
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
+from util import get_today_date, extract_json, contains_json, remove_source, build_conversation
+from init_azure import create_credential, init_project, close_project, get_agents, summary_thread, make_message, get_latest_messages, create_thread, run_agent, stream_agent
 from cal_com_methods import try_to_make_an_appointment
 
 load_dotenv()
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(url, key)
+# Set in lifespan so that it shares the app's pooled HTTP client.
+supabase: AsyncClient = None
+
+# Connection pool size of the Supabase client (per worker).
+# Roughly the number of requests that are expected to talk to Supabase at the same time
+# (the inserts are batched, so there are less connections than chats).
+supabase_max_connections = int(os.getenv("SUPABASE_MAX_CONNECTIONS", 40))
+supabase_max_keepalive_connections = 20
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    task = asyncio.create_task(save_finished_threads())
+    global supabase, agent_data, agent_summary
+
+    # One pooled HTTP client per library, shared by every request, instead of
+    # a new connection pool per client.
+    # (Supabase is built on httpx and Azure's async SDK on aiohttp, so they can't share a single session.)
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=supabase_max_connections,
+            max_keepalive_connections=supabase_max_keepalive_connections,
+            keepalive_expiry=30
+        ),
+        timeout=httpx.Timeout(30.0, connect=5.0),
+        http2=True
+    )
+    azure_session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, keepalive_timeout=30, ttl_dns_cache=300)
+    )
+
+    supabase = await acreate_client(url, key, options=AsyncClientOptions(httpx_client=http_client))
+
+    # Created here instead of at import so that importing the app stays cheap
+    # and the credential is created once per worker.
+    app.state.credential = await asyncio.to_thread(create_credential)
+
+    await init_project(azure_session, app.state.credential)
+    agent_data, agent_summary = get_agents()
+
+    flush_task = asyncio.create_task(flush_chatbot_rows())
     yield
 
     # cleanup on shutdown
-    task.cancel()
+    for handle in ONGOING_THREADS.values():
+        handle.cancel()
+    ONGOING_THREADS.clear()
+    # Let the running summaries finish before the clients are closed
+    await asyncio.gather(*SUMMARY_TASKS, return_exceptions=True)
+
+    # Letting the flusher insert every queued row (including the batch it's sending right now)
+    # before it's cancelled, so that no batch is interrupted halfway
+    await CHATBOT_ROWS.join()
+    flush_task.cancel()
     try:
-        await task
+        await flush_task
     except asyncio.CancelledError:
         pass
 
+    await close_project()
+    await app.state.credential.close()
+    await azure_session.close()
+    await http_client.aclose()
+
 app = FastAPI(lifespan=lifespan)
 
 # Allow frontend (JavaScript in browser) to talk to backend
@@ -42,40 +92,154 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-agent_data, agent_summary, agent_summary_thread = get_agents()
+# Set in lifespan once the Azure project client is initialized.
+agent_data, agent_summary = None, None
 
 
-# Store the last message's time for each thread.
+# Store the summary timer of each ongoing thread (asyncio.TimerHandle).
+# The timer is restarted with every message of the user.
 ONGOING_THREADS = {}
 
 # How much time a user has to respond before the chat is archived (in seconds)
 time_limit_user_message = 600
 
-async def save_finished_threads():
-    while True:
-        # Limit the number of threads to check so that it doesn't take up a lot of time
-        threads_to_check = 4
-        # making a list so that the changes are not made during the iteration
-        threads_to_remove = []
+# How many of the newest messages of a conversation are summarized
+summary_max_messages = 100
+
+# Summaries that are running in the background
+SUMMARY_TASKS = set()
+# Locks of the threads that are being summarized right now
+SUMMARY_LOCKS = {}
+
+# Rows waiting to be inserted into the chatbot_data table.
+# They are inserted in batches by flush_chatbot_rows instead of one request per message.
+CHATBOT_ROWS = asyncio.Queue()
+# Number of queued (not yet inserted) rows of each thread
+PENDING_ROWS = {}
+# Set once a thread has no queued rows left (only for threads that have queued rows)
+ROWS_STORED = {}
+
+# A batch is sent once it has this many rows or once this much time (in seconds) has passed
+batch_max_rows = 25
+batch_max_wait = 0.05
+# How many times a batch is sent before its rows are inserted one by one
+insert_attempts = 3
+
+def reset_thread_timer(thread_id):
+    """Restart the countdown after which the conversation is summarized."""
+    handle = ONGOING_THREADS.pop(thread_id, None)
+    if handle:
+        handle.cancel()
+
+    # The event loop keeps its timers in a heap ordered by expiry time, so
+    # scheduling/cancelling is O(log n) and only expired timers are ever looked at.
+    loop = asyncio.get_running_loop()
+    ONGOING_THREADS[thread_id] = loop.call_later(time_limit_user_message, archive_thread, thread_id)
+
+
+def archive_thread(thread_id):
+    """Called by the timer once the user hasn't responded in time."""
+    ONGOING_THREADS.pop(thread_id, None)
+    start_summary(thread_id)
+
+
+def start_summary(thread_id):
+    """Run make_summary in the background so that the caller doesn't wait
+    for the summary agent."""
+    task = asyncio.create_task(make_summary(thread_id))
+
+    # Keeping a reference so that the task isn't garbage collected before it's done
+    SUMMARY_TASKS.add(task)
+    task.add_done_callback(SUMMARY_TASKS.discard)
 
-        for thread_id, last_message_time in ONGOING_THREADS.items():
-            if threads_to_check == 0:
-                break
-            
-            time_now = time.time()
-            if time_now - last_message_time > time_limit_user_message:
-                threads_to_remove.append(thread_id)
 
-                await make_summary(thread_id)
+def store_rows(rows):
+    """Queue rows for the chatbot_data table. They are inserted by flush_chatbot_rows."""
+    for row in rows:
+        thread_id = row["thread_id"]
+        PENDING_ROWS[thread_id] = PENDING_ROWS.get(thread_id, 0) + 1
+        ROWS_STORED.setdefault(thread_id, asyncio.Event())
+        CHATBOT_ROWS.put_nowait(row)
 
-        threads_to_check -= 1
-        for thread_id in threads_to_remove:
-            ONGOING_THREADS.pop(thread_id, None)
 
-        await asyncio.sleep(600)
+def mark_rows_stored(rows):
+    """Called by flush_chatbot_rows once the rows were inserted (or given up on)."""
+    for row in rows:
+        thread_id = row["thread_id"]
+        PENDING_ROWS[thread_id] -= 1
+        if PENDING_ROWS[thread_id] == 0:
+            del PENDING_ROWS[thread_id]
+            ROWS_STORED.pop(thread_id).set()
+        CHATBOT_ROWS.task_done()
 
 
-def insert_chatbot_message(thread_id, table_name=None, chatbot_type="data", msg=None):
+async def wait_for_rows_stored(thread_id):
+    """Wait until the queued rows of this thread are in the database.
+    Rows of other threads don't matter, so a busy queue doesn't hold this up."""
+    event = ROWS_STORED.get(thread_id)
+    if event:
+        await event.wait()
+
+
+async def insert_rows(rows):
+    """Insert a batch of rows into chatbot_data.
+
+    The batch mixes rows of different conversations, so a failure must not lose all of them:
+    the batch is retried a few times (for temporary errors), then the rows are inserted one by one
+    so that only a row that really can't be inserted is lost (and logged)."""
+    if not rows:
+        return
+
+    delay = 0.5
+    for attempt in range(insert_attempts):
+        try:
+            response = await (
+                supabase.table("chatbot_data")
+                .insert(rows)
+                .execute()
+            )
+            return
+        except Exception as e:
+            print(f"Failed to insert {len(rows)} rows into chatbot_data (attempt {attempt + 1}): {e}")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    for row in rows:
+        try:
+            response = await (
+                supabase.table("chatbot_data")
+                .insert(row)
+                .execute()
+            )
+        except Exception as e:
+            print(f"Lost chatbot_data row of thread {row['thread_id']} ({row['role']}: {row['message']!r}): {e}")
+
+
+async def flush_chatbot_rows():
+    """Background task that collects queued rows (up to batch_max_rows, or
+    whatever arrived within batch_max_wait) and inserts them with one request."""
+    loop = asyncio.get_running_loop()
+
+    while True:
+        rows = [await CHATBOT_ROWS.get()]
+        deadline = loop.time() + batch_max_wait
+
+        while len(rows) < batch_max_rows:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(await asyncio.wait_for(CHATBOT_ROWS.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            await insert_rows(rows)
+        finally:
+            mark_rows_stored(rows)
+
+
+async def insert_chatbot_message(thread_id, table_name=None, chatbot_type="data", msg=None, rows=None):
     """Function that gets a chatbot message and
     inserts it into supabase database."
     
@@ -84,52 +248,67 @@ def insert_chatbot_message(thread_id, table_name=None, chatbot_type="data", msg=
         table_name: supabase table to where the data is going to be sent
         chatbot_type: which chatbot to send the data to
         msg: optional. If not None, just adds that message to the supabase. Used to store automatic messages (successful/unsuccessful reservation)
+        rows: optional. If not None, the chatbot_data row is appended to it instead of being stored right away,
+        so that the caller can store all the rows of a request at once.
 
     Returns:
         Dict: A dictionary consisting of the role (assistant/chatbot in this case), the message, and the thread id.
     """
 
+    if rows is None:
+        rows = []
+        chatbot_message = await insert_chatbot_message(thread_id, table_name, chatbot_type, msg, rows)
+        store_rows(rows)
+        return chatbot_message
+
     if msg:
-        response = (
-        supabase.table("chatbot_data")
-        .insert({"role": "assistant", "thread_id": thread_id, "message": msg["message"], "agent_id": agent_data.id})
-        .execute()
-        )
+        rows.append({"role": "assistant", "thread_id": thread_id, "message": msg["message"], "agent_id": agent_data.id})
         return
 
-    messages = get_message_list(thread_id)
-    
-    for message in reversed(messages):
+    # Returns at the first (newest) answer, so only the newest page(s) are fetched
+    async for message in get_latest_messages(thread_id):
         if message.role == "assistant" and message.text_messages:
             message_to_insert = message.text_messages[-1].text.value
             message_to_insert = remove_source(message_to_insert)
 
-            try:
-                message_to_insert = extract_json(message_to_insert)
+            # Cheap check first so that plain text messages (the usual case)
+            # don't have to go through extract_json and its ValueError.
+            is_json = False
+            if contains_json(message_to_insert):
+                try:
+                    message_to_insert = extract_json(message_to_insert)
+                    is_json = True
+                # Caused by extract_json method when the braces aren't valid JSON
+                except ValueError:
+                    pass
 
+            if is_json:
                 # Summary agent
                 if chatbot_type == "summary":
                     
-                    response = (
+                    response = await (
                         supabase.table(table_name)
                         .insert(message_to_insert)
                         .execute()
                     )
                     return 
                 # For unambiguity purposes. 
-                # In case the chatbot type is data and the message doesn't cause a ValueError, 
+                # In case the chatbot type is data and the message is JSON,
                 # it means that it's a JSON message of reservation data which we don't want to store.
                 else:
                     pass
 
             # Happens in case it's a pure message rather than JSON
-            # Caused by extract_json method
-            except ValueError:
-                    response = (
-                        supabase.table(table_name)
-                        .insert({"role": "assistant", "thread_id": thread_id, "message": message_to_insert, "agent_id": agent_data.id})
-                        .execute()
-                    )
+            else:
+                    row = {"role": "assistant", "thread_id": thread_id, "message": message_to_insert, "agent_id": agent_data.id}
+                    if table_name == "chatbot_data":
+                        rows.append(row)
+                    else:
+                        response = await (
+                            supabase.table(table_name)
+                            .insert(row)
+                            .execute()
+                        )
             
             return {"role": "assistant", "message": message_to_insert, "thread_id": thread_id, "agent_id": agent_data.id}
     
@@ -153,39 +332,36 @@ async def give_thread_id(request: Request):
     user_input = data["message"]
 
     # Creating a thread for a new user
-    thread = create_thread()
+    thread = await create_thread()
 
     # Telling the bot today's date so it doesn't make mistakes when reserving an appointment.
     # Executed every time a conversation is started so that it is relevant for every conversation.
     today = get_today_date()
 
-    make_message(thread.id, "user", f"System message: Vandaag is {today[0]}, {today[1]}, {today[2]}. Gebruik deze datum altijd als referentie")
+    await make_message(thread.id, "user", f"System message: Vandaag is {today[0]}, {today[1]}, {today[2]}. Gebruik deze datum altijd als referentie")
 
     # In case it's an initial message when the user clicks on start a conversation
     # (In the other case, it means that the user ran out of time and starts a new conversation but with the chat already opened)
     if user_input == None:
         run = await run_agent(thread.id, agent_data.id)
         return {"thread_id": thread.id}
-    else:
-        response_user = (
-        supabase.table("chatbot_data")
-        .insert({"role": "user", "message": user_input, "thread_id": thread.id, "agent_id": agent_data.id})
-        .execute()
-    )
+    # Stored together with the chatbot's answer once the run is over
+    rows = [{"role": "user", "message": user_input, "thread_id": thread.id, "agent_id": agent_data.id}]
 
-
-    ONGOING_THREADS[thread.id] = time.time() 
+    reset_thread_timer(thread.id)
 
     # Initial message to get initial response from the chatbot
-    make_message(thread.id, "user", user_input)
+    await make_message(thread.id, "user", user_input)
 
     run = await run_agent(thread.id, agent_data.id)
 
-    if run.status == "failed":
+    if run.status != "completed":
+        store_rows(rows)
         return {"role": "assistant", "message": f"Run failed: {run.last_error}"}
     
 
-    chatbot_message = insert_chatbot_message(thread.id, "chatbot_data")
+    chatbot_message = await insert_chatbot_message(thread.id, "chatbot_data", rows=rows)
+    store_rows(rows)
     
     return chatbot_message
 
@@ -194,59 +370,132 @@ async def chat(request: Request):
     data = await request.json()
     user_input = data["message"]
     user_thread_id = data["thread_id"]
-    ONGOING_THREADS[user_thread_id] = time.time() 
+    reset_thread_timer(user_thread_id)
 
-    make_message(user_thread_id, "user", user_input)
+    await make_message(user_thread_id, "user", user_input)
 
-    response_user = (
-        supabase.table("chatbot_data")
-        .insert({"role": "user", "message": user_input, "thread_id": user_thread_id, "agent_id": agent_data.id})
-        .execute()
+    # Stored together with the chatbot's answer once the run is over
+    rows = [{"role": "user", "message": user_input, "thread_id": user_thread_id, "agent_id": agent_data.id}]
+
+    return StreamingResponse(
+        chat_event_stream(user_thread_id, rows),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
     )
 
-    run = await run_agent(user_thread_id, agent_data.id)
 
-    if run.status == "failed":
-        return {"role": "assistant", "message": f"Run failed: {run.last_error}"}
-      
-    chatbot_message = insert_chatbot_message(user_thread_id, "chatbot_data")
+def server_sent_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    msg = await try_to_make_an_appointment(chatbot_message)
 
-    if msg["message"] != chatbot_message["message"]:
-        insert_chatbot_message(user_thread_id, msg=msg)
-    return msg
-    
+async def chat_event_stream(thread_id, rows):
+    """Server-Sent Events of /chat.
+
+    Sends "delta" events with parts of the answer while the agent is generating it,
+    and one "message" event at the end with the final message (the same dict /chat used to return).
+    The final message replaces the streamed text, since it can still change
+    (sources removed, reservation result instead of reservation JSON)."""
+    try:
+        # Set once a source or reservation JSON starts, the user shouldn't see those
+        holding_back = False
+        run = None
+
+        async for event, data in stream_agent(thread_id, agent_data.id):
+            if event == "run":
+                run = data
+                continue
+            if holding_back:
+                continue
+
+            for marker in ("{", "【"):
+                position = data.find(marker)
+                if position != -1:
+                    data = data[:position]
+                    holding_back = True
+
+            if data:
+                yield server_sent_event("delta", {"text": data})
+
+        if run.status != "completed":
+            yield server_sent_event("message", {"role": "assistant", "message": f"Run failed: {run.last_error}"})
+            return
+
+        chatbot_message = await insert_chatbot_message(thread_id, "chatbot_data", rows=rows)
+
+        msg = await try_to_make_an_appointment(chatbot_message)
+
+        if msg["message"] != chatbot_message["message"]:
+            await insert_chatbot_message(thread_id, msg=msg, rows=rows)
+
+        yield server_sent_event("message", msg)
+    # The response has already started, so the error can only be reported as the final message.
+    # Otherwise the widget would be left without an answer.
+    except Exception as e:
+        print(f"Chat stream of thread {thread_id} failed: {e!r}")
+        yield server_sent_event("message", {"role": "assistant", "message": "Er is iets misgegaan. Probeer het later opnieuw.", "thread_id": thread_id})
+    finally:
+        store_rows(rows)
+
 @app.post("/end_conversation")
 async def end_conversation(request: Request):
     data = await request.json()
     thread_id = data["thread_id"]
 
-    ONGOING_THREADS.pop(thread_id, None)
+    handle = ONGOING_THREADS.pop(thread_id, None)
+    if handle:
+        handle.cancel()
 
-    await make_summary(thread_id)
+    start_summary(thread_id)
 
 
 
 async def make_summary(thread_id):
+    lock = SUMMARY_LOCKS.setdefault(thread_id, asyncio.Lock())
+
+    # The summary is already being made (e.g. the timer ran out while the user ended the conversation),
+    # so it would only be inserted twice.
+    if lock.locked():
+        return
+
+    async with lock:
+        try:
+            await _make_summary(thread_id)
+        finally:
+            SUMMARY_LOCKS.pop(thread_id, None)
+
+
+async def _make_summary(thread_id):
+    # Making sure the queued messages of the conversation are in the database
+    await wait_for_rows_stored(thread_id)
+
     # Get a conversation in JSON format
-    message_list = (
+    response = await (
         supabase.table("chatbot_data")
         .select("role, message")
         .eq("thread_id", thread_id)
         .eq("agent_id", agent_data.id)
+        # Only the newest messages are summarized, so only those are fetched (newest first)
+        .order("id", desc=True)
+        .limit(summary_max_messages)
         .execute()
-        ).data
+        )
+    message_list = response.data[::-1]
 
-    conversation = "".join(f"{message['role']}: {message['message']}\n" for message in message_list)
+    conversation = build_conversation(message_list, max_messages=summary_max_messages)
 
     # Preventing from storing an empty conversation (when the user started a dialogue but didn't send anything)
     if conversation != "":
 
-        # Make a message with conversation as value (summary agent)
-        make_message(agent_summary_thread.id, "user", conversation)
+        async with summary_thread() as thread:
+            # Make a message with conversation as value (summary agent)
+            await make_message(thread.id, "user", conversation)
+
+            # Pass the message onto summary agent
+            run = await run_agent(thread.id, agent_summary.id)
 
-        # Pass the message onto summary agent
-        run = await run_agent(agent_summary_thread.id, agent_summary.id)
+            # The newest answer on the (pooled) thread would be the summary of another conversation
+            if run.status != "completed":
+                print(f"Summary of thread {thread_id} failed ({run.status}): {run.last_error}")
+                return
 
-        insert_chatbot_message(agent_summary_thread.id, "hands_summary_data", "summary")
+            await insert_chatbot_message(thread.id, "hands_summary_data", "summary")
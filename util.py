@@ -3,6 +3,10 @@ import datetime
 from dateutil import parser
 from zoneinfo import ZoneInfo
 import re
+import io
+
+
+EMAIL_PATTERN = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
 
 def get_month_name(number, language):
     month_name = None
@@ -79,14 +83,16 @@ def remove_source(s: str):
 
     if start != -1 and end != -1:
         s = s[0:start] + s[end+1:]
-    
-    while True:
-        if s[-1] == " " or s[-1] == "\n":
-            s = s[:-1]
-        else:
-            break
 
-    return s
+    return s.rstrip(" \n")
+
+
+def contains_json(s: str):
+    """Cheap check whether the string can contain a JSON object at all
+    (an opening brace followed by a closing one), so that plain messages
+    can skip extract_json."""
+    start = s.find("{")
+    return start != -1 and s.rfind("}") > start
 
 
 def extract_json(s: str):
@@ -105,9 +111,36 @@ def extract_json(s: str):
     json_str = s[start:end+1]
     return json.loads(json_str)
 
+def build_conversation(message_list, max_messages=100, max_length=16000, head_length=2000, tail_length=12000):
+    """Turn a list of {"role", "message"} dicts into the text that's sent to the summary agent.
+
+    Only the last max_messages messages are used and an assistant message that directly repeats
+    the previous one (with no user message in between) is skipped.
+    If the text is longer than max_length, only its start (head_length) and end (tail_length) are kept."""
+    buffer = io.StringIO()
+    previous_message = None
+
+    for message in message_list[-max_messages:]:
+        if message["role"] == "assistant" and message == previous_message:
+            continue
+        previous_message = message
+
+        buffer.write(message["role"])
+        buffer.write(": ")
+        buffer.write(message["message"])
+        buffer.write("\n")
+
+    conversation = buffer.getvalue()
+
+    if len(conversation) > max_length:
+        conversation = conversation[:head_length] + "\n...\n" + conversation[-tail_length:]
+
+    return conversation
+
+
 def validate_email(email):
     """Return email if it's validated. Return False otherwise."""
-    is_valid = bool(re.fullmatch(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}", email))
+    is_valid = bool(EMAIL_PATTERN.fullmatch(email))
 
     if is_valid:
         return email